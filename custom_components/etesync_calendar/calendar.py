@@ -1,3 +1,7 @@
+import asyncio
+import itertools
+import os
+import threading
 import voluptuous as vol
 import logging
 import pytz
@@ -5,7 +9,11 @@ import pytz
 from datetime import timedelta, time, date, datetime
 from dateutil.relativedelta import relativedelta
 from etesync import Authenticator, EteSync
-from typing import Optional, Dict, List, Tuple, Generator
+from etesync.crypto import derive_key
+from etesync.exceptions import UnauthorizedException
+from typing import Optional, Dict, List, Tuple, Generator, Iterable
+
+from aiohttp import web
 
 from homeassistant.components.calendar import (
     ENTITY_ID_FORMAT,
@@ -13,7 +21,9 @@ from homeassistant.components.calendar import (
     CalendarEventDevice
 )
 
+from homeassistant.components.http import HomeAssistantView
 from homeassistant.const import (
+    ATTR_ENTITY_ID,
     CONF_PASSWORD,
     CONF_URL,
     CONF_USERNAME,
@@ -21,11 +31,20 @@ from homeassistant.const import (
     STATE_OFF,
     STATE_ON
 )
+from homeassistant.exceptions import HomeAssistantError
 import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers.entity import generate_entity_id
-from homeassistant.util import Throttle
-
-from .helpers import parse, parse_iso8601_duration, read_from_cache, write_to_cache
+from homeassistant.util import Throttle, slugify
+import homeassistant.util.dt as dt_util
+
+from .export import CONTENT_TYPES, EXPORT_FORMATS, FORMAT_ICS, write_export
+from .helpers import (
+    parse,
+    parse_iso8601_duration,
+    migrate_legacy_cache,
+    read_cache,
+    write_cache
+)
 
 DOMAIN = 'etesync_calendar'
 
@@ -33,71 +52,264 @@ PARALLEL_UPDATES = 1
 
 CONF_ENCRYPTION_PASSWORD = 'encryption_password'
 CONF_DEFAULT_TIMEZONE = 'default_timezone'
+CONF_ACCOUNTS = 'accounts'
 CACHE_FOLDER = 'custom_components/etesync_calendar/cache'
 
 CALENDAR_ITEM_TYPE = 'CALENDAR'
 
-PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
+SERVICE_EXPORT_EVENTS = 'export_events'
+ATTR_START = 'start'
+ATTR_END = 'end'
+ATTR_FORMAT = 'format'
+ATTR_FILENAME = 'filename'
+
+# Number of export lines generated per executor job when streaming over http
+EXPORT_CHUNK_LINES = 500
+
+EXPORT_EVENTS_SCHEMA = vol.Schema(
+    {
+        vol.Optional(ATTR_ENTITY_ID): cv.entity_ids,
+        vol.Required(ATTR_START): cv.datetime,
+        vol.Required(ATTR_END): cv.datetime,
+        vol.Optional(ATTR_FORMAT, default=FORMAT_ICS): vol.In(list(EXPORT_FORMATS)),
+        vol.Required(ATTR_FILENAME): cv.string,
+    }
+)
+
+ACCOUNT_SCHEMA = vol.Schema(
     {
         vol.Required(CONF_URL): vol.Url(),
         vol.Required(CONF_USERNAME): cv.string,
         vol.Required(CONF_PASSWORD): cv.string,
         vol.Required(CONF_ENCRYPTION_PASSWORD): cv.string,
-        vol.Optional(CONF_DEFAULT_TIMEZONE, default='Europe/Amsterdam'): cv.string,
-        # vol.Optional(CONF_VERIFY_SSL, default=True): cv.boolean,
+        vol.Optional(CONF_DEFAULT_TIMEZONE): cv.string,
     }
 )
 
+PLATFORM_SCHEMA = vol.All(
+    PLATFORM_SCHEMA.extend(
+        {
+            # A single account can be configured on the platform itself...
+            vol.Inclusive(CONF_URL, 'account'): vol.Url(),
+            vol.Inclusive(CONF_USERNAME, 'account'): cv.string,
+            vol.Inclusive(CONF_PASSWORD, 'account'): cv.string,
+            vol.Inclusive(CONF_ENCRYPTION_PASSWORD, 'account'): cv.string,
+            # ... or several under accounts, each set up concurrently
+            vol.Optional(CONF_ACCOUNTS): vol.All(cv.ensure_list, [ACCOUNT_SCHEMA]),
+            vol.Optional(CONF_DEFAULT_TIMEZONE, default='Europe/Amsterdam'): cv.string,
+            # vol.Optional(CONF_VERIFY_SSL, default=True): cv.boolean,
+        }
+    ),
+    cv.has_at_least_one_key(CONF_USERNAME, CONF_ACCOUNTS),
+)
+
 _LOGGER = logging.getLogger(__name__)
 
-DEFAULT_TIMEZONE = ''
+# etesync keeps its database in a process wide proxy that every EteSync instance re-initializes,
+# so everything that touches the database runs for one account at a time
+_ETESYNC_DB_LOCK = threading.Lock()
 
 
-def setup_platform(hass, config, add_entities, discovery_info=None):
-    url = config[CONF_URL]
-    username = config[CONF_USERNAME]
-    password = config[CONF_PASSWORD]
-    encryption_password = config[CONF_ENCRYPTION_PASSWORD]
+async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
+    """Set up all configured accounts concurrently on the shared executor."""
+    accounts = _accounts_from_config(config)
+    cache_folder = hass.config.path(CACHE_FOLDER)
 
-    global DEFAULT_TIMEZONE
-    DEFAULT_TIMEZONE = config[CONF_DEFAULT_TIMEZONE]
+    # Single account installs kept their cache in the root cache folder
+    account_folders = {(account[CONF_URL], account[CONF_USERNAME]): _account_cache_folder(cache_folder, account)
+                       for account in accounts}
+    await hass.async_add_executor_job(migrate_legacy_cache, cache_folder, account_folders)
 
-    cache_folder = hass.config.path(CACHE_FOLDER)
-    credentials = read_from_cache(cache_folder)
+    results = await asyncio.gather(
+        *[_async_setup_account(hass, account, cache_folder) for account in accounts],
+        return_exceptions=True
+    )
 
-    if credentials and _credentials_not_changed((url, username, password), credentials):
-        _LOGGER.info("Using cached credentials")
-        url, username, password, cipher_key = credentials
+    devices = []
+    for account, result in zip(accounts, results):
+        username = account[CONF_USERNAME]
+        if isinstance(result, Exception):
+            _LOGGER.error("Could not set up account %s", username, exc_info=result)
+            continue
+
+        for calendar in result:
+            name = f"{username}-{calendar.name}"
+            entity_id = generate_entity_id(ENTITY_ID_FORMAT, name, hass=hass)
+            devices.append(EteSyncCalendarEventDevice(hass, calendar, entity_id))
+            hass.data.setdefault(DOMAIN, {})[entity_id] = calendar
+    # The calendars were just synced and parsed, updating them before adding would sync every account again
+    async_add_entities(devices)
 
-        auth_token = Authenticator(url).get_auth_token(username, password)
-        ete_sync = EteSync(username, auth_token, remote=url, cipher_key=cipher_key)
-    else:
-        # Token should be saved instead of requested every time
+    _async_setup_export(hass)
+
+
+def _async_setup_export(hass):
+    """Register the export service and http view once for all platform entries."""
+    if hass.services.has_service(DOMAIN, SERVICE_EXPORT_EVENTS):
+        return
+
+    async def async_export_events(call):
+        filename = hass.config.path(call.data[ATTR_FILENAME])
+        if not hass.config.is_allowed_path(filename):
+            raise HomeAssistantError(f"Not allowed to export to {filename}, add it to allowlist_external_dirs")
+
+        occurrences = _occurrences(_calendars(hass, call.data.get(ATTR_ENTITY_ID)),
+                                   dt_util.as_utc(call.data[ATTR_START]),
+                                   dt_util.as_utc(call.data[ATTR_END]))
+        await hass.async_add_executor_job(write_export, filename, occurrences, call.data[ATTR_FORMAT])
+        _LOGGER.info("Exported events to %s", filename)
+
+    hass.services.async_register(DOMAIN, SERVICE_EXPORT_EVENTS, async_export_events, schema=EXPORT_EVENTS_SCHEMA)
+    hass.http.register_view(EteSyncExportView)
+
+
+def _calendars(hass, entity_ids: Optional[List[str]]) -> List[Tuple[str, "EteSyncCalendar"]]:
+    """Returns the (entity id, calendar) pairs for entity_ids or all calendars if None."""
+    calendars = hass.data.get(DOMAIN, {})
+    if entity_ids is None:
+        return list(calendars.items())
+    return [(entity_id, calendars[entity_id]) for entity_id in entity_ids if entity_id in calendars]
+
+
+def _occurrences(calendars: Iterable[Tuple[str, "EteSyncCalendar"]],
+                 start_date: datetime,
+                 end_date: datetime) -> Generator[Tuple[str, "EteSyncEvent"], None, None]:
+    """Generator for the (entity id, event) occurrences of all calendars within a datetime range."""
+    for entity_id, calendar in calendars:
+        for event in calendar.events_in_range(start_date, end_date):
+            yield entity_id, event
+
+
+class EteSyncExportView(HomeAssistantView):
+    """Stream the occurrences of one or all calendars as ICS or JSON lines."""
+
+    url = '/api/etesync_calendar/export'
+    name = 'api:etesync_calendar:export'
+
+    async def get(self, request):
+        hass = request.app['hass']
+        try:
+            start = dt_util.parse_datetime(request.query[ATTR_START])
+            end = dt_util.parse_datetime(request.query[ATTR_END])
+        except KeyError:
+            return self.json_message('Missing start or end', 400)
+        if start is None or end is None:
+            return self.json_message('Invalid start or end', 400)
+
+        export_format = request.query.get(ATTR_FORMAT, FORMAT_ICS)
+        if export_format not in EXPORT_FORMATS:
+            return self.json_message('Invalid format', 400)
+
+        entity_ids = request.query.getall(ATTR_ENTITY_ID, None)
+        occurrences = _occurrences(_calendars(hass, entity_ids), dt_util.as_utc(start), dt_util.as_utc(end))
+        lines = EXPORT_FORMATS[export_format](occurrences)
+
+        response = web.StreamResponse(headers={'Content-Type': CONTENT_TYPES[export_format]})
+        await response.prepare(request)
+        try:
+            while True:
+                # Generate in the executor, only one chunk of lines is in memory at a time
+                chunk = await hass.async_add_executor_job(_next_chunk, lines)
+                if not chunk:
+                    break
+                await response.write(chunk.encode())
+            await response.write_eof()
+        except ConnectionResetError:
+            _LOGGER.debug("Client disconnected during export")
+        return response
+
+
+def _next_chunk(lines: Iterable[str]) -> str:
+    return ''.join(itertools.islice(lines, EXPORT_CHUNK_LINES))
+
+
+def _accounts_from_config(config) -> List[dict]:
+    """Returns the configured accounts, each with its own default timezone."""
+    accounts = list(config.get(CONF_ACCOUNTS, []))
+    if CONF_USERNAME in config:
+        accounts.insert(0, config)
+
+    return [{
+        CONF_URL: account[CONF_URL],
+        CONF_USERNAME: account[CONF_USERNAME],
+        CONF_PASSWORD: account[CONF_PASSWORD],
+        CONF_ENCRYPTION_PASSWORD: account[CONF_ENCRYPTION_PASSWORD],
+        CONF_DEFAULT_TIMEZONE: account.get(CONF_DEFAULT_TIMEZONE, config[CONF_DEFAULT_TIMEZONE]),
+    } for account in accounts]
+
+
+async def _async_setup_account(hass, account: dict, cache_folder: str) -> List["EteSyncCalendar"]:
+    """Set up a single account, restoring and storing its cache off the event loop."""
+    account_cache_folder = _account_cache_folder(cache_folder, account)
+    cache = await hass.async_add_executor_job(read_cache, account_cache_folder)
+
+    calendars, cache = await hass.async_add_executor_job(_setup_account, account, cache)
+    await hass.async_add_executor_job(write_cache, account_cache_folder, cache)
+    return calendars
+
+
+def _account_cache_folder(cache_folder: str, account: dict) -> str:
+    """Every account gets its own cache so they do not overwrite each others key."""
+    return os.path.join(cache_folder, slugify(f"{account[CONF_URL]}-{account[CONF_USERNAME]}"))
+
+
+def _setup_account(account: dict, cache: Optional[dict]) -> Tuple[List["EteSyncCalendar"], dict]:
+    """Login, sync and parse the calendars of a single account. Blocking, runs in the executor.
+    Only the login and key derivation run concurrently with other accounts.
+    Returns the calendars and the cache to store for the next start.
+    """
+    url = account[CONF_URL]
+    username = account[CONF_USERNAME]
+    password = account[CONF_PASSWORD]
+    encryption_password = account[CONF_ENCRYPTION_PASSWORD]
+    default_timezone = account[CONF_DEFAULT_TIMEZONE]
+
+    cipher_key, auth_token = None, None
+    if cache and _credentials_not_changed((url, username, password),
+                                          (cache['url'], cache['username'], cache['password'])):
+        _LOGGER.info("Using cached credentials for %s", username)
+        cipher_key, auth_token = cache['cipher_key'], cache['auth_token']
+
+    token_from_cache = auth_token is not None
+    if not token_from_cache:
         auth_token = Authenticator(url).get_auth_token(username, password)
 
-        ete_sync = EteSync(username, auth_token, remote=url)
-        _LOGGER.warning("Deriving key, this could take some time")
-        # Very slow operation, should probably be securely cached
-        cipher_key = ete_sync.derive_key(encryption_password)
+    if cipher_key is None:
+        _LOGGER.warning("Deriving key for %s, this could take some time", username)
+        # Very slow operation, the result is cached
+        cipher_key = derive_key(encryption_password, username)
         _LOGGER.info("Key derived. Cache result for faster startup times")
-        write_to_cache(cache_folder, url, username, password, cipher_key)
 
-    _LOGGER.info("Syncing")
-    ete_sync.sync()
-    _LOGGER.info("Syncing done")
+    with _ETESYNC_DB_LOCK:
+        ete_sync = EteSync(username, auth_token, remote=url, cipher_key=cipher_key)
 
-    journals = list(ete_sync.list())
-    _LOGGER.info("Journals found: %s", str(len(journals)))
-    devices = []
+        _LOGGER.info("Syncing %s", username)
+        try:
+            ete_sync.sync()
+        except UnauthorizedException:
+            if not token_from_cache:
+                raise
+            _LOGGER.info("Cached auth token for %s expired, requesting a new one", username)
+            ete_sync.auth_token = Authenticator(url).get_auth_token(username, password)
+            ete_sync.sync()
+        _LOGGER.info("Syncing %s done", username)
+
+        journals = list(ete_sync.list())
+        _LOGGER.info("Journals found for %s: %s", username, str(len(journals)))
 
-    for journal in journals:
         # Filter task list / address book's
-        if journal.info['type'] == CALENDAR_ITEM_TYPE:
-            name = f"{username}-{journal.info['displayName']}"
-            entity_id = generate_entity_id(ENTITY_ID_FORMAT, name, hass=hass)
-            device = EteSyncCalendarEventDevice(hass, journal, ete_sync, entity_id)
-            devices.append(device)
-    add_entities(devices, True)
+        journals = [journal for journal in journals if journal.info['type'] == CALENDAR_ITEM_TYPE]
+
+        calendars = [EteSyncCalendar(journal, ete_sync, default_timezone) for journal in journals]
+
+    cache = {
+        'url': url,
+        'username': username,
+        'password': password,
+        'cipher_key': cipher_key,
+        'auth_token': ete_sync.auth_token,
+    }
+    return calendars, cache
 
 
 def _credentials_not_changed(old, new) -> bool:
@@ -109,11 +321,11 @@ def _credentials_not_changed(old, new) -> bool:
     return True
 
 
-def add_timezone(dt: datetime, tz: Optional[str]) -> datetime:
-    """Add the given tz timezone to the datetime and return the result"""
+def add_timezone(dt: datetime, tz: Optional[str], default_tz: str) -> datetime:
+    """Add the given tz timezone, or default_tz if none, to the datetime and return the result"""
 
     if tz is None or tz.lower() == 'date':
-        return pytz.timezone(DEFAULT_TIMEZONE).localize(dt)
+        return pytz.timezone(default_tz).localize(dt)
 
     if dt is not None and tz is not None:
         return pytz.timezone(tz).localize(dt)
@@ -122,9 +334,9 @@ def add_timezone(dt: datetime, tz: Optional[str]) -> datetime:
 class EteSyncCalendarEventDevice(CalendarEventDevice):
     """A device for a single etesync calendar."""
 
-    def __init__(self, hass, calendar, ete_sync, entity_id):
+    def __init__(self, hass, calendar: "EteSyncCalendar", entity_id):
         self._hass = hass
-        self._calendar = EteSyncCalendar(calendar, ete_sync)
+        self._calendar = calendar
         self._entity_id = entity_id
 
     @property
@@ -175,17 +387,17 @@ class EteSyncCalendarEventDevice(CalendarEventDevice):
 class EteSyncCalendar:
     """Class that represents an etesync calendar."""
 
-    def __init__(self, raw_data, ete_sync: "EteSync"):
+    def __init__(self, raw_data, ete_sync: "EteSync", default_timezone: str):
         """Initialize the EteSyncCalendar class."""
         self._raw_data = raw_data
         self._ete_sync = ete_sync
+        self._default_timezone = default_timezone
         self._event_descriptions: List[EteSyncEventDescription] = []
         self._build_events()
 
     def _build_events(self):
         events = self._raw_data.collection.list()
-        for event in events:
-            self._event_descriptions.append(EteSyncEventDescription(event))
+        self._event_descriptions = [EteSyncEventDescription(event, self._default_timezone) for event in events]
         # self._event_descriptions.sort(key=lambda e: e.start)
 
     def get_events_in_range(self, start_date: datetime, end_date: datetime):
@@ -201,6 +413,16 @@ class EteSyncCalendar:
                     break
         return events
 
+    def events_in_range(self, start_date: datetime, end_date: datetime) -> Generator["EteSyncEvent", None, None]:
+        """Generator for the event occurrences that overlap a datetime range."""
+        for event_description in self._event_descriptions:
+            for event in event_description.events():
+                if event.start >= end_date:
+                    break
+
+                if event.end > start_date:
+                    yield event
+
     @property
     def name(self):
         """Return the name of the Calendar"""
@@ -230,16 +452,18 @@ class EteSyncCalendar:
     @Throttle(timedelta(minutes=5))
     def update(self):
         """Update the calendar data"""
-        self._ete_sync.sync()
-        # TODO update data
-        self._raw_data = self._ete_sync.get(self._raw_data.uid)
-        self._build_events()
+        with _ETESYNC_DB_LOCK:
+            self._ete_sync.sync()
+            # TODO update data
+            self._raw_data = self._ete_sync.get(self._raw_data.uid)
+            self._build_events()
 
 
 class EteSyncEventDescription:
 
-    def __init__(self, event_data):
+    def __init__(self, event_data, default_timezone: str):
         self._raw_data = event_data
+        self._default_timezone = default_timezone
         raw_properties = event_data.content.splitlines()
         properties = []
 
@@ -279,13 +503,17 @@ class EteSyncEventDescription:
         return id, summary, description, is_all_day
 
     def _is_all_day(self):
+        if self._get_time('dtstart')['timezone'] == 'date':
+            # DTSTART;VALUE=DATE:20200420
+            return True
+
         start = self._start()
         end = self._end()
         duration = self._duration()
         if end is None or self._is_recurring():
             # 60 * 60 * 24 = 86400 seconds a day
             return duration.total_seconds() > 86399
-        return not self._is_recurring and (start - end).total_seconds() > 86399
+        return (end - start).total_seconds() > 86399
 
     def _is_recurring(self) -> bool:
         return self._event['vcalendar']['vevent'].get('rrule') is not None
@@ -299,10 +527,10 @@ class EteSyncEventDescription:
         timeobj = self._get_time('dtstart')
 
         timezone = timeobj.get('timezone')
-        parsed_time = self._parse_date_time(timeobj['time'], timezone)
+        parsed_time = self._parse_date_time(timeobj['time'], timezone, self._default_timezone)
 
         if parsed_time is None:
-            return add_timezone(datetime.min, 'utc')
+            return add_timezone(datetime.min, 'utc', self._default_timezone)
         return parsed_time
 
     def _end(self) -> datetime:
@@ -316,13 +544,13 @@ class EteSyncEventDescription:
             if start is not None and start.time == time.min:
                 return datetime.combine(start.date(), time.max, start.tzinfo)
             else:
-                return add_timezone(datetime.max, 'utc')
+                return add_timezone(datetime.max, 'utc', self._default_timezone)
 
         timezone = timeobj.get('timezone')
-        parsed_time = self._parse_date_time(timeobj['time'], timezone)
+        parsed_time = self._parse_date_time(timeobj['time'], timezone, self._default_timezone)
 
         if parsed_time is None:
-            return add_timezone(datetime.max, 'utc')
+            return add_timezone(datetime.max, 'utc', self._default_timezone)
         return parsed_time
 
     def _interval(self) -> relativedelta:
@@ -342,10 +570,14 @@ class EteSyncEventDescription:
 
     def _get_time(self, name: str) -> Optional[Dict[str, str]]:
         """Read the time form the raw data."""
-        return self._event['vcalendar']['vevent'].get(name)
+        timeobj = self._event['vcalendar']['vevent'].get(name)
+        if isinstance(timeobj, str):
+            # DTSTART:20200612T170000Z is in utc, without TZID or Z it is in the default timezone
+            return {'timezone': 'utc' if timeobj.endswith('Z') else None, 'time': timeobj}
+        return timeobj
 
     @staticmethod
-    def _parse_date_time(raw_datetime: str, timezone: str) -> Optional[datetime]:
+    def _parse_date_time(raw_datetime: str, timezone: str, default_timezone: str) -> Optional[datetime]:
         """Parse datetime in format 'YYYYMMDDTHHmmss'"""
         if not raw_datetime:
             return None
@@ -365,7 +597,7 @@ class EteSyncEventDescription:
             dt = datetime(year=int(year), month=int(month), day=int(day),
                                    hour=int(hours), minute=int(minutes), second=int(seconds))
 
-        return add_timezone(dt, timezone)
+        return add_timezone(dt, timezone, default_timezone)
 
 
 class EteSyncEvent:
@@ -0,0 +1,80 @@
+""" Streaming export of EteSync calendar occurrences. """
+import json
+
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Callable, Dict, Generator, Iterable, Tuple
+
+if TYPE_CHECKING:
+    from .calendar import EteSyncEvent
+
+FORMAT_ICS = 'ics'
+FORMAT_JSONL = 'jsonl'
+
+ICS_DATETIME_FORMAT = '%Y%m%dT%H%M%SZ'
+ICS_DATE_FORMAT = '%Y%m%d'
+
+
+def ics_lines(occurrences: Iterable[Tuple[str, "EteSyncEvent"]]) -> Generator[str, None, None]:
+    """Generator for the lines of an ICS file with one VEVENT per (calendar, event) occurrence."""
+    yield 'BEGIN:VCALENDAR\r\n'
+    yield 'VERSION:2.0\r\n'
+    yield 'PRODID:-//etesync_calendar//export//EN\r\n'
+
+    timestamp = _ics_datetime(datetime.now(timezone.utc))
+    for calendar, event in occurrences:
+        yield 'BEGIN:VEVENT\r\n'
+        # Occurrences are exported without their recurrence rule, each gets its own uid
+        yield f'UID:{_ics_escape(event.id)}-{_ics_datetime(event.start)}\r\n'
+        yield f'DTSTAMP:{timestamp}\r\n'
+        if event.is_all_day:
+            yield f'DTSTART;VALUE=DATE:{event.start.strftime(ICS_DATE_FORMAT)}\r\n'
+            yield f'DTEND;VALUE=DATE:{event.end.strftime(ICS_DATE_FORMAT)}\r\n'
+        else:
+            yield f'DTSTART:{_ics_datetime(event.start)}\r\n'
+            yield f'DTEND:{_ics_datetime(event.end)}\r\n'
+        yield f'SUMMARY:{_ics_escape(event.summary)}\r\n'
+        if event.description:
+            yield f'DESCRIPTION:{_ics_escape(event.description)}\r\n'
+        yield f'CATEGORIES:{_ics_escape(calendar)}\r\n'
+        yield 'END:VEVENT\r\n'
+
+    yield 'END:VCALENDAR\r\n'
+
+
+def json_lines(occurrences: Iterable[Tuple[str, "EteSyncEvent"]]) -> Generator[str, None, None]:
+    """Generator for one JSON object per line for every (calendar, event) occurrence."""
+    for calendar, event in occurrences:
+        yield json.dumps({
+            'calendar': calendar,
+            'id': event.id,
+            'summary': event.summary,
+            'description': event.description,
+            'all_day': event.is_all_day,
+            'start': event.start.isoformat(),
+            'end': event.end.isoformat(),
+        }) + '\n'
+
+
+EXPORT_FORMATS: Dict[str, Callable[[Iterable[Tuple[str, "EteSyncEvent"]]], Generator[str, None, None]]] = {
+    FORMAT_ICS: ics_lines,
+    FORMAT_JSONL: json_lines,
+}
+
+CONTENT_TYPES = {
+    FORMAT_ICS: 'text/calendar',
+    FORMAT_JSONL: 'application/x-ndjson',
+}
+
+
+def write_export(path: str, occurrences: Iterable[Tuple[str, "EteSyncEvent"]], export_format: str):
+    """Write the occurrences to path line by line, the occurrences are never all in memory at once."""
+    with open(path, 'tw', newline='') as stream:
+        stream.writelines(EXPORT_FORMATS[export_format](occurrences))
+
+
+def _ics_datetime(dt: datetime) -> str:
+    return dt.astimezone(timezone.utc).strftime(ICS_DATETIME_FORMAT)
+
+
+def _ics_escape(text: str) -> str:
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
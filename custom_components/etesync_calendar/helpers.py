@@ -1,11 +1,23 @@
+import base64
+import json
 import os
 import logging
+import re
+import tempfile
 
 from datetime import timedelta
-from typing import List, Tuple, Optional
+from typing import Dict, List, Tuple, Optional
 
 _LOGGER = logging.getLogger(__name__)
 
+# Properties with an iCalendar TEXT value, stored unescaped
+TEXT_PROPERTIES = ('summary', 'description', 'location', 'comment')
+TEXT_ESCAPE = re.compile(r'\\([\\;,nN])')
+
+CACHE_FILE = 'cache.json'
+CACHE_VERSION = 1
+
+# Files of the unversioned single account cache, migrated to CACHE_FILE when found
 CACHE_FILE_TEXT = 'secret_check'
 CACHE_FILE_BIN = 'secret_key'
 
@@ -36,6 +48,9 @@ def _parse(entries) -> dict:
         if key == 'rrule':
             value = _parse_repeating(value)
 
+        if key in TEXT_PROPERTIES:
+            value = _unescape_text(value)
+
         if result.get(key):
             val = result[key]
             has_append = getattr(val, "append", None)
@@ -58,6 +73,11 @@ def _parse_repeating(value: str):
     return result
 
 
+def _unescape_text(value: str) -> str:
+    """Unescape an iCalendar TEXT value, e.g. 'Lunch\\, with Bob' becomes 'Lunch, with Bob'."""
+    return TEXT_ESCAPE.sub(lambda match: '\n' if match.group(1) in 'nN' else match.group(1), value)
+
+
 def _parse_keyed_timezone(key: str, value: str):
     if ';' not in key or '=' not in key:
         return key, value
@@ -73,36 +93,113 @@ def _parse_keyed_timezone(key: str, value: str):
     })
 
 
-def read_from_cache(folder) -> (str, str, str, []):
-    file_t = os.path.join(folder, CACHE_FILE_TEXT)
-    file_w = os.path.join(folder, CACHE_FILE_BIN)
-    if os.path.exists(file_t) and os.path.isfile(file_t):
-        try:
-            with open(file_t, 'tr') as stream:
-                url = stream.readline().strip()
-                username = stream.readline().strip()
-                password = stream.readline().strip()
-            with open(file_w, 'br') as stream:
-                cipher_key = stream.read()
-            return url, username, password, cipher_key
-        except IOError:
-            os.remove(file_t)
+def read_cache(folder: str) -> Optional[dict]:
+    """
+    Read the cache from folder.
+    :return: dict with url, username, password, cipher_key and auth_token or None if not cached.
+    """
+    file = os.path.join(folder, CACHE_FILE)
+    if not os.path.isfile(file):
+        return None
+
+    try:
+        with open(file, 'tr') as stream:
+            stored = json.load(stream)
+        version = stored['version']
+        if version > CACHE_VERSION:
+            _LOGGER.warning("Cache version %s is newer than supported version %s, ignored", version, CACHE_VERSION)
+            return None
+        data = _migrate_cache(version, stored['data'])
+        data['cipher_key'] = base64.b64decode(data['cipher_key'])
+        return data
+    except (IOError, ValueError, KeyError, TypeError):
+        _LOGGER.warning("Cache file corrupted, removed")
+        _remove(file)
     return None
 
 
-def write_to_cache(folder: str, url: str, username: str, password: str, cipher_key: []):
-    if not os.path.exists(folder):
-        os.makedirs(folder)
+def write_cache(folder: str, data: dict) -> bool:
+    """
+    Write data to the cache in folder. The file is replaced atomically, it is never half written.
+    :return: True if the cache was written.
+    """
+    data = dict(data)
+    data['cipher_key'] = base64.b64encode(data['cipher_key']).decode('ascii')
 
-    file_t = os.path.join(folder, CACHE_FILE_TEXT)
-    file_b = os.path.join(folder, CACHE_FILE_BIN)
+    file = os.path.join(folder, CACHE_FILE)
     try:
-        with open(file_t, 'tw') as stream:
-            stream.write('\n'.join([url, username, password]))
-        with open(file_b, 'bw') as stream:
-            stream.write(cipher_key)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        fd, temp_file = tempfile.mkstemp(dir=folder, prefix=CACHE_FILE, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'tw') as stream:
+                json.dump({'version': CACHE_VERSION, 'data': data}, stream)
+                stream.flush()
+                os.fsync(stream.fileno())
+            os.replace(temp_file, file)
+        except BaseException:
+            os.remove(temp_file)
+            raise
     except IOError:
         _LOGGER.warning("Could not write cache file")
+        return False
+    return True
+
+
+def _migrate_cache(version: int, data: dict) -> dict:
+    """Bring data stored with an older cache version up to CACHE_VERSION."""
+    # Version 1 is the first versioned schema, add migration steps here when it changes
+    return data
+
+
+def migrate_legacy_cache(legacy_folder: str, account_folders: Dict[Tuple[str, str], str]):
+    """
+    Migrate the unversioned cache files in legacy_folder to the cache of the account they belong to.
+    The files are only removed once they are migrated, or if that account already has a cache.
+    :param account_folders: The cache folder of every configured account by (url, username).
+    """
+    file_t = os.path.join(legacy_folder, CACHE_FILE_TEXT)
+    file_b = os.path.join(legacy_folder, CACHE_FILE_BIN)
+    if not os.path.isfile(file_t):
+        return
+
+    try:
+        with open(file_t, 'tr') as stream:
+            url = stream.readline().strip()
+            username = stream.readline().strip()
+            password = stream.readline().strip()
+        with open(file_b, 'br') as stream:
+            cipher_key = stream.read()
+    except IOError:
+        _remove(file_t)
+        return
+
+    folder = account_folders.get((url, username))
+    if folder is None:
+        return
+
+    if not os.path.isfile(os.path.join(folder, CACHE_FILE)):
+        data = {
+            'url': url,
+            'username': username,
+            'password': password,
+            'cipher_key': cipher_key,
+            'auth_token': None,
+        }
+        if not write_cache(folder, data):
+            return
+        _LOGGER.info("Migrated cache of %s to version %s", username, CACHE_VERSION)
+
+    _remove(file_t)
+    _remove(file_b)
+
+
+def _remove(file: str):
+    """Remove file, it is fine if it is already gone."""
+    try:
+        os.remove(file)
+    except FileNotFoundError:
+        pass
 
 
 def parse_iso8601_duration(duration_text: str) -> Optional[timedelta]:
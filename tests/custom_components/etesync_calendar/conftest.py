@@ -0,0 +1,8 @@
+try:
+    import homeassistant.components.calendar as ha_calendar
+except ImportError:
+    ha_calendar = None
+
+if ha_calendar is not None and not hasattr(ha_calendar, 'CalendarEventDevice'):
+    # Removed from newer Home Assistant versions, CalendarEntity replaced it
+    ha_calendar.CalendarEventDevice = ha_calendar.CalendarEntity
@@ -1,57 +1,162 @@
 from os import listdir, path, makedirs
+import json
 import tempfile
 import custom_components.etesync_calendar.helpers as helper
 
 
-def test_write_to_cache():
-    folder = path.join(tempfile.gettempdir(), tempfile.gettempprefix(), 'test_write_to_cache')
-    url = 'https://test.test'
-    username = 'testuser'
-    password = 'mypass'
-    cipher = bytes([15, 123, 51])
+def _cache_data(url='https://test.nl', cipher=bytes([1, 2, 3, 4, 5])):
+    return {
+        'url': url,
+        'username': 'username',
+        'password': 'drowssap',
+        'cipher_key': cipher,
+        'auth_token': 'token',
+    }
+
+
+def test_write_cache():
+    folder = path.join(tempfile.gettempdir(), tempfile.gettempprefix(), 'test_write_cache')
 
-    helper.write_to_cache(folder, url, username, password, cipher)
+    helper.write_cache(folder, _cache_data())
 
-    assert len(listdir(folder)) == 2
+    assert listdir(folder) == [helper.CACHE_FILE]
 
 
-def test_read_from_cache_not_cached_returns_none():
-    folder = path.join(tempfile.gettempdir(), tempfile.gettempprefix(), 'test_read_from_cache_not_cached_returns_none')
+def test_read_cache_not_cached_returns_none():
+    folder = path.join(tempfile.gettempdir(), tempfile.gettempprefix(), 'test_read_cache_not_cached_returns_none')
 
-    assert helper.read_from_cache(folder) is None
+    assert helper.read_cache(folder) is None
 
 
-def test_read_from_cache_corrupted_returns_none():
-    folder = path.join(tempfile.gettempdir(), tempfile.gettempprefix(), 'test_read_from_cache_corrupted_returns_none')
+def test_read_cache_corrupted_returns_none():
+    folder = path.join(tempfile.gettempdir(), tempfile.gettempprefix(), 'test_read_cache_corrupted_returns_none')
 
     if not path.exists(folder):
         makedirs(folder)
     # create incomplete file
+    with open(path.join(folder, helper.CACHE_FILE), 'tw') as file:
+        file.write('{"version": 1, "data": {"url"')
+
+    assert helper.read_cache(folder) is None
+    assert not path.exists(path.join(folder, helper.CACHE_FILE))
+
+
+def test_read_cache_newer_version_returns_none():
+    folder = path.join(tempfile.gettempdir(), tempfile.gettempprefix(), 'test_read_cache_newer_version_returns_none')
+
+    if not path.exists(folder):
+        makedirs(folder)
+    with open(path.join(folder, helper.CACHE_FILE), 'tw') as file:
+        json.dump({'version': helper.CACHE_VERSION + 1, 'data': {}}, file)
+
+    assert helper.read_cache(folder) is None
+
+
+def test_read_cache_after_write_returns_result():
+    folder = path.join(tempfile.gettempdir(), tempfile.gettempprefix(), 'test_read_cache_after_write_returns_result')
+    data = _cache_data()
+
+    helper.write_cache(folder, data)
+
+    assert helper.read_cache(folder) == data
+
+
+def test_write_cache_replaces_previous_cache():
+    folder = path.join(tempfile.gettempdir(), tempfile.gettempprefix(), 'test_write_cache_replaces_previous_cache')
+
+    helper.write_cache(folder, _cache_data(url='https://old.nl'))
+    helper.write_cache(folder, _cache_data(url='https://new.nl'))
+
+    assert helper.read_cache(folder)['url'] == 'https://new.nl'
+    assert listdir(folder) == [helper.CACHE_FILE]
+
+
+def _write_legacy_cache(folder, cipher):
     with open(path.join(folder, helper.CACHE_FILE_TEXT), 'tw') as file:
+        file.write('https://test.test\ntestuser\nmypass')
+    with open(path.join(folder, helper.CACHE_FILE_BIN), 'bw') as file:
+        file.write(cipher)
+
+
+def test_migrate_legacy_cache(tmp_path):
+    legacy_folder = str(tmp_path)
+    folder = path.join(legacy_folder, 'account')
+    other_folder = path.join(legacy_folder, 'other')
+    cipher = bytes([15, 123, 51])
+    _write_legacy_cache(legacy_folder, cipher)
+
+    helper.migrate_legacy_cache(legacy_folder, {('https://test.test', 'otheruser'): other_folder,
+                                                ('https://test.test', 'testuser'): folder})
+
+    result = helper.read_cache(folder)
+    assert result['url'] == 'https://test.test'
+    assert result['username'] == 'testuser'
+    assert result['password'] == 'mypass'
+    assert result['cipher_key'] == cipher
+    assert result['auth_token'] is None
+    assert listdir(legacy_folder) == ['account']
+
+
+def test_migrate_legacy_cache_of_other_account_keeps_files(tmp_path):
+    legacy_folder = str(tmp_path)
+    folder = path.join(legacy_folder, 'account')
+    _write_legacy_cache(legacy_folder, bytes([15, 123, 51]))
+
+    helper.migrate_legacy_cache(legacy_folder, {('https://test.test', 'otheruser'): folder})
+
+    assert sorted(listdir(legacy_folder)) == [helper.CACHE_FILE_TEXT, helper.CACHE_FILE_BIN]
+
+
+def test_migrate_legacy_cache_keeps_existing_cache(tmp_path):
+    legacy_folder = str(tmp_path)
+    folder = path.join(legacy_folder, 'account')
+    data = _cache_data()
+    helper.write_cache(folder, data)
+    _write_legacy_cache(legacy_folder, bytes([15, 123, 51]))
+
+    helper.migrate_legacy_cache(legacy_folder, {('https://test.test', 'testuser'): folder})
+
+    assert helper.read_cache(folder) == data
+    assert listdir(legacy_folder) == ['account']
+
+
+def test_migrate_legacy_cache_write_failure_keeps_files(tmp_path):
+    legacy_folder = str(tmp_path)
+    _write_legacy_cache(legacy_folder, bytes([15, 123, 51]))
+    # the account folder can not be created below a file
+    folder = path.join(legacy_folder, helper.CACHE_FILE_BIN, 'account')
+
+    helper.migrate_legacy_cache(legacy_folder, {('https://test.test', 'testuser'): folder})
+
+    assert sorted(listdir(legacy_folder)) == [helper.CACHE_FILE_TEXT, helper.CACHE_FILE_BIN]
+
+
+def test_migrate_legacy_cache_corrupted_removed(tmp_path):
+    legacy_folder = str(tmp_path)
+    folder = path.join(legacy_folder, 'account')
+    # create incomplete file
+    with open(path.join(legacy_folder, helper.CACHE_FILE_TEXT), 'tw') as file:
         file.write('url\n')
         file.write('user\n')
 
-    assert helper.read_from_cache(folder) is None
-    assert not path.exists(path.join(folder, helper.CACHE_FILE_TEXT))
+    helper.migrate_legacy_cache(legacy_folder, {('url', 'user'): folder})
+
+    assert listdir(legacy_folder) == []
+
 
+def test_migrate_legacy_cache_without_legacy_files(tmp_path):
+    folder = path.join(str(tmp_path), 'account')
 
-def test_read_from_cache_after_write_returns_result():
-    folder = path.join(tempfile.gettempdir(), tempfile.gettempprefix(),
-                       'test_read_from_cache_after_write_returns_result')
-    url = 'https://test.nl'
-    username = 'username'
-    password = 'drowssap'
-    cipher = bytes([1, 2, 3, 4, 5])
+    helper.migrate_legacy_cache(str(tmp_path), {('https://test.test', 'testuser'): folder})
 
-    helper.write_to_cache(folder, url, username, password, cipher)
+    assert listdir(str(tmp_path)) == []
 
-    result = helper.read_from_cache(folder)
 
-    assert len(result) == 4
-    assert result[0] == url
-    assert result[1] == username
-    assert result[2] == password
-    assert result[3] == cipher
+def test_write_cache_failure_returns_false(tmp_path):
+    blocker = tmp_path / 'file'
+    blocker.write_text('')
+
+    assert not helper.write_cache(str(blocker / 'account'), _cache_data())
 
 
 def test_parse_empty_returns_empty_dict():
@@ -71,3 +176,17 @@ def test_parse():
 
     assert result is not None
     assert result['calendar']['event']['summary'] == 'do a thing'
+
+
+def test_parse_unescapes_text():
+    input = [('begin', 'VEVENT'),
+             ('summary', 'Lunch\\, with Bob\\; room 1'),
+             ('description', 'first\\nsecond \\\\ third'),
+             ('uid', 'a\\,b'),
+             ('end', 'VEVENT')]
+
+    result = helper.parse(input)
+
+    assert result['vevent']['summary'] == 'Lunch, with Bob; room 1'
+    assert result['vevent']['description'] == 'first\nsecond \\ third'
+    assert result['vevent']['uid'] == 'a\\,b'
@@ -0,0 +1,72 @@
+import pytest
+import voluptuous as vol
+
+pytest.importorskip('homeassistant')
+
+import custom_components.etesync_calendar.calendar as calendar  # noqa: E402
+
+ACCOUNT = {
+    'url': 'https://test.nl',
+    'username': 'username',
+    'password': 'drowssap',
+    'encryption_password': 'secret',
+}
+
+OTHER_ACCOUNT = {
+    'url': 'https://other.nl',
+    'username': 'other',
+    'password': 'other-password',
+    'encryption_password': 'other-secret',
+    'default_timezone': 'America/New_York',
+}
+
+
+def _platform_config(**config):
+    return calendar.PLATFORM_SCHEMA({'platform': calendar.DOMAIN, **config})
+
+
+def test_platform_schema_single_account():
+    config = _platform_config(**ACCOUNT)
+
+    assert config['username'] == 'username'
+    assert config['default_timezone'] == 'Europe/Amsterdam'
+
+
+def test_platform_schema_incomplete_single_account_invalid():
+    with pytest.raises(vol.Invalid):
+        _platform_config(url='https://test.nl', username='username', accounts=[OTHER_ACCOUNT])
+
+
+def test_platform_schema_without_account_invalid():
+    with pytest.raises(vol.Invalid):
+        _platform_config()
+
+
+def test_platform_schema_accounts():
+    config = _platform_config(accounts=[ACCOUNT, OTHER_ACCOUNT])
+
+    assert len(config['accounts']) == 2
+    assert 'default_timezone' not in config['accounts'][0]
+
+
+def test_platform_schema_invalid_account():
+    with pytest.raises(vol.Invalid):
+        _platform_config(accounts=[{'url': 'https://test.nl', 'username': 'username'}])
+
+
+def test_accounts_from_config_single_account():
+    accounts = calendar._accounts_from_config(_platform_config(default_timezone='UTC', **ACCOUNT))
+
+    assert accounts == [{**ACCOUNT, 'default_timezone': 'UTC'}]
+
+
+def test_accounts_from_config_default_timezone_fallback():
+    accounts = calendar._accounts_from_config(_platform_config(accounts=[ACCOUNT, OTHER_ACCOUNT]))
+
+    assert accounts == [{**ACCOUNT, 'default_timezone': 'Europe/Amsterdam'}, OTHER_ACCOUNT]
+
+
+def test_accounts_from_config_single_and_accounts():
+    accounts = calendar._accounts_from_config(_platform_config(accounts=[OTHER_ACCOUNT], **ACCOUNT))
+
+    assert [account['username'] for account in accounts] == ['username', 'other']
@@ -0,0 +1,193 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+import json
+import pytest
+
+pytest.importorskip('homeassistant')
+
+import custom_components.etesync_calendar.calendar as calendar  # noqa: E402
+import custom_components.etesync_calendar.export as export  # noqa: E402
+
+NON_RECURRING = '''BEGIN:VCALENDAR
+BEGIN:VEVENT
+UID:{uid}
+SUMMARY:do a thing
+DTSTART;TZID=UTC:{start}
+DTEND;TZID=UTC:{end}
+END:VEVENT
+END:VCALENDAR'''
+
+ALL_DAY = '''BEGIN:VCALENDAR
+BEGIN:VEVENT
+UID:all-day
+SUMMARY:whole day
+DTSTART;VALUE=DATE:20200420
+DTEND;VALUE=DATE:20200421
+END:VEVENT
+END:VCALENDAR'''
+
+ESCAPED_TEXT = r'''BEGIN:VCALENDAR
+BEGIN:VEVENT
+UID:lunch
+SUMMARY:Lunch\, with Bob\; room 1
+DESCRIPTION:first\nsecond
+DTSTART;TZID=UTC:20200612T120000
+DTEND;TZID=UTC:20200612T130000
+END:VEVENT
+END:VCALENDAR'''
+
+# Daily from 10:00 to 11:00, the last occurrence starts before the DTEND
+RECURRING = '''BEGIN:VCALENDAR
+BEGIN:VEVENT
+UID:recurring
+SUMMARY:daily thing
+DTSTART;TZID=UTC:20200601T100000
+DTEND;TZID=UTC:20200610T110000
+DURATION:PT1H
+RRULE:FREQ=DAILY
+END:VEVENT
+END:VCALENDAR'''
+
+
+def _utc(day, hour, minute=0, month=6):
+    return datetime(2020, month, day, hour, minute, tzinfo=timezone.utc)
+
+
+def _event(uid, start, end):
+    return NON_RECURRING.format(uid=uid, start=start, end=end)
+
+
+def _calendar(*contents, default_timezone='Europe/Amsterdam'):
+    raw_data = SimpleNamespace(
+        info={'displayName': 'Test'},
+        collection=SimpleNamespace(list=lambda: [SimpleNamespace(content=content) for content in contents])
+    )
+    return calendar.EteSyncCalendar(raw_data, None, default_timezone)
+
+
+def _ids(events):
+    return [(event.id, event.start) for event in events]
+
+
+def test_events_in_range_partial_overlap_at_start():
+    cal = _calendar(_event('overlap', '20200612T093000', '20200612T103000'))
+
+    result = _ids(cal.events_in_range(_utc(12, 10), _utc(12, 12)))
+
+    assert result == [('overlap', _utc(12, 9, 30))]
+
+
+def test_events_in_range_partial_overlap_at_end():
+    cal = _calendar(_event('overlap', '20200612T113000', '20200612T123000'))
+
+    result = _ids(cal.events_in_range(_utc(12, 10), _utc(12, 12)))
+
+    assert result == [('overlap', _utc(12, 11, 30))]
+
+
+def test_events_in_range_ending_at_start_excluded():
+    cal = _calendar(_event('before', '20200612T090000', '20200612T100000'))
+
+    assert list(cal.events_in_range(_utc(12, 10), _utc(12, 12))) == []
+
+
+def test_events_in_range_starting_at_end_excluded():
+    cal = _calendar(_event('after', '20200612T120000', '20200612T130000'))
+
+    assert list(cal.events_in_range(_utc(12, 10), _utc(12, 12))) == []
+
+
+def test_events_in_range_recurring_crossing_window():
+    cal = _calendar(RECURRING)
+
+    result = _ids(cal.events_in_range(_utc(3, 10, 30), _utc(5, 10)))
+
+    assert result == [('recurring', _utc(3, 10)), ('recurring', _utc(4, 10))]
+
+
+def test_events_without_tzid_use_default_timezone():
+    content = NON_RECURRING.replace(';TZID=UTC', '').format(uid='local', start='20200612T170000', end='20200612T180000')
+    cal = _calendar(content, default_timezone='America/New_York')
+
+    event = next(cal.events_in_range(_utc(1, 0), _utc(30, 0)))
+
+    assert event.start == _utc(12, 21)
+    assert event.end == _utc(12, 22)
+
+
+def test_events_in_utc_without_tzid():
+    content = NON_RECURRING.replace(';TZID=UTC', '').format(uid='utc', start='20200612T170000Z', end='20200612T180000Z')
+    cal = _calendar(content, default_timezone='America/New_York')
+
+    event = next(cal.events_in_range(_utc(1, 0), _utc(30, 0)))
+
+    assert event.start == _utc(12, 17)
+
+
+def test_events_all_day():
+    event = next(_calendar(ALL_DAY).events_in_range(_utc(1, 0, month=4), _utc(30, 0, month=4)))
+
+    assert event.is_all_day
+
+
+def test_events_timed_not_all_day():
+    cal = _calendar(_event('timed', '20200612T100000', '20200612T110000'))
+
+    event = next(cal.events_in_range(_utc(1, 0), _utc(30, 0)))
+
+    assert not event.is_all_day
+
+
+def test_ics_export_all_day():
+    occurrences = calendar._occurrences([('calendar.test', _calendar(ALL_DAY))],
+                                        _utc(1, 0, month=4), _utc(30, 0, month=4))
+
+    result = ''.join(export.ics_lines(occurrences))
+
+    assert 'DTSTART;VALUE=DATE:20200420\r\n' in result
+    assert 'DTEND;VALUE=DATE:20200421\r\n' in result
+
+
+def test_ics_export_escapes_text_once():
+    occurrences = calendar._occurrences([('calendar.test', _calendar(ESCAPED_TEXT))], _utc(12, 0), _utc(13, 0))
+
+    result = ''.join(export.ics_lines(occurrences))
+
+    assert 'SUMMARY:Lunch\\, with Bob\\; room 1\r\n' in result
+    assert 'DESCRIPTION:first\\nsecond\r\n' in result
+
+
+def test_json_export_unescaped_text():
+    occurrences = calendar._occurrences([('calendar.test', _calendar(ESCAPED_TEXT))], _utc(12, 0), _utc(13, 0))
+
+    result = json.loads(next(export.json_lines(occurrences)))
+
+    assert result['summary'] == 'Lunch, with Bob; room 1'
+    assert result['description'] == 'first\nsecond'
+
+
+def test_occurrences_of_all_calendars():
+    first = _calendar(_event('first', '20200612T100000', '20200612T110000'))
+    second = _calendar(_event('second', '20200612T110000', '20200612T120000'),
+                       _event('outside', '20200613T110000', '20200613T120000'))
+
+    result = [(entity_id, event.id) for entity_id, event in calendar._occurrences(
+        [('calendar.first', first), ('calendar.second', second)], _utc(12, 0), _utc(13, 0))]
+
+    assert result == [('calendar.first', 'first'), ('calendar.second', 'second')]
+
+
+def test_calendars_filters_entity_ids():
+    first, second = _calendar(), _calendar()
+    hass = SimpleNamespace(data={calendar.DOMAIN: {'calendar.first': first, 'calendar.second': second}})
+
+    assert calendar._calendars(hass, None) == [('calendar.first', first), ('calendar.second', second)]
+    assert calendar._calendars(hass, ['calendar.second', 'calendar.unknown']) == [('calendar.second', second)]
+
+
+def test_next_chunk_streams_lines():
+    lines = iter(str(i) for i in range(calendar.EXPORT_CHUNK_LINES + 1))
+
+    assert len(calendar._next_chunk(lines)) > 0
+    assert calendar._next_chunk(lines) == str(calendar.EXPORT_CHUNK_LINES)
+    assert calendar._next_chunk(lines) == ''
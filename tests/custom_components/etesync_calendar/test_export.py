@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta, timezone
+import json
+import custom_components.etesync_calendar.export as export
+
+
+class FakeEvent:
+    def __init__(self, event_id, start, duration=timedelta(hours=1), is_all_day=False):
+        self.id = event_id
+        self.summary = 'do a thing; now'
+        self.description = ''
+        self.start = start
+        self.end = start + duration
+        self.is_all_day = is_all_day
+
+
+def _occurrences(count):
+    start = datetime(2020, 6, 12, 17, 0, 0, tzinfo=timezone.utc)
+    for i in range(count):
+        yield 'calendar.test', FakeEvent('uid', start + timedelta(days=i))
+
+
+def test_json_lines():
+    lines = list(export.json_lines(_occurrences(2)))
+
+    assert len(lines) == 2
+    result = json.loads(lines[1])
+    assert result['calendar'] == 'calendar.test'
+    assert result['id'] == 'uid'
+    assert result['start'] == '2020-06-13T17:00:00+00:00'
+    assert result['end'] == '2020-06-13T18:00:00+00:00'
+
+
+def test_ics_lines():
+    result = ''.join(export.ics_lines(_occurrences(1)))
+
+    assert result.startswith('BEGIN:VCALENDAR\r\n')
+    assert result.count('BEGIN:VEVENT\r\n') == 1
+    assert result.endswith('END:VCALENDAR\r\n')
+    assert 'UID:uid-20200612T170000Z\r\n' in result
+    assert 'DTSTAMP:' in result
+    assert 'RECURRENCE-ID' not in result
+    assert 'DTSTART:20200612T170000Z\r\n' in result
+    assert 'DTEND:20200612T180000Z\r\n' in result
+    assert 'SUMMARY:do a thing\\; now\r\n' in result
+
+
+def test_ics_lines_occurrences_have_unique_uid():
+    result = ''.join(export.ics_lines(_occurrences(2)))
+
+    assert 'UID:uid-20200612T170000Z\r\n' in result
+    assert 'UID:uid-20200613T170000Z\r\n' in result
+
+
+def test_ics_lines_all_day():
+    occurrences = [('calendar.test', FakeEvent('uid', datetime(2020, 4, 20, tzinfo=timezone.utc),
+                                               timedelta(days=1), True))]
+
+    result = ''.join(export.ics_lines(occurrences))
+
+    assert 'DTSTART;VALUE=DATE:20200420\r\n' in result
+    assert 'DTEND;VALUE=DATE:20200421\r\n' in result
+
+
+def test_ics_lines_is_lazy():
+    lines = export.ics_lines(_occurrences(10 ** 9))
+
+    assert next(lines) == 'BEGIN:VCALENDAR\r\n'
+    assert next(lines) == 'VERSION:2.0\r\n'
+
+
+def test_write_export(tmp_path):
+    file = str(tmp_path / 'export.jsonl')
+
+    export.write_export(file, _occurrences(3), export.FORMAT_JSONL)
+
+    with open(file, 'tr') as stream:
+        assert len(stream.readlines()) == 3